@@ -2,20 +2,888 @@ import cv2
 from skimage.metrics import structural_similarity as ssim
 import numpy as np
 import FreeSimpleGUI as sg
+import contextlib
+import io
 import json
+import multiprocessing
 import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 captured_image = None
+captured_gray = None
+shift_estimator = None
+pyramid_comparer = None
 window = None
 color_window = None
 cap = None
+results_log = None
+image_writer = None
+inspection_state = None
+inspection_server = None
+latency_stats = None
 similarity_threshold = 0.5  # Default threshold value
 auto_compare = False  # Auto-compare mode flag
 diff_scale_factor = 1.0  # Default scale factor for difference image
 live_scale_factor = 1.0  # Default scale factor for live frame
 stream_width = 640  # Default stream width
 stream_height = 480  # Default stream height
+use_mjpeg = True  # Request MJPEG from the camera and keep frames compressed
+use_fast_ssim = False  # Use the float32 OpenCV SSIM instead of skimage's float64 one
+use_latest_frame = (
+    False  # Always hand out the newest camera frame, dropping queued ones
+)
+
+
+# Decode flags for libjpeg DCT scaling, keyed by reduction factor
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+# Most frames grabbed and dropped to reach the newest one, OpenCV's V4L2
+# backend queues 4 buffers by default
+MAX_DRAIN_GRABS = 5
+
+
+# GUI backends whose image widget can show the camera's JPEG bytes as they are
+JPEG_PREVIEW_BACKENDS = ("FreeSimpleGUIWeb",)
+
+
+# Class to hold a camera frame and decode compressed (MJPEG) data only on demand
+class CameraFrame:
+    def __init__(self, image=None, jpeg=None, timestamp=None):
+        self.jpeg = jpeg
+        # Capture time on the time.monotonic() clock
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+        self._decoded = {}
+        if image is not None:
+            self._decoded[1] = image
+
+    def image(self, scale_factor=1.0):
+        # A full resolution image is cheaper to resize than to decode again
+        if 1 in self._decoded or self.jpeg is None:
+            return self._decoded[1]
+
+        # Pick the largest DCT reduction that still covers the requested scale
+        reduction = 1
+        for factor in (8, 4, 2):
+            if scale_factor <= 1.0 / factor:
+                reduction = factor
+                break
+        if reduction not in self._decoded:
+            self._decoded[reduction] = cv2.imdecode(
+                self.jpeg, REDUCED_DECODE_FLAGS[reduction]
+            )
+        return self._decoded[reduction]
+
+
+# Class to append comparison results to SQLite from a background writer thread
+class ResultsLog:
+    def __init__(self, file_path, batch_size=200, flush_interval=0.5):
+        self.file_path = file_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.records = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def record(self, camera, rect, score, decision, threshold, scale=1.0):
+        # Only a queue put happens on the caller's thread
+        self.records.put(
+            (
+                time.time(),
+                camera,
+                json.dumps(list(rect)),
+                score,
+                decision,
+                threshold,
+                scale,
+            )
+        )
+
+    def close(self):
+        self.records.put(None)
+        self.thread.join()
+
+    def _run(self):
+        db = sqlite3.connect(self.file_path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "timestamp REAL, camera INTEGER, roi TEXT, score REAL, "
+            "decision TEXT, threshold REAL, scale REAL)"
+        )
+        # Logs written before the scale column existed get it added
+        columns = [row[1] for row in db.execute("PRAGMA table_info(results)")]
+        if "scale" not in columns:
+            db.execute("ALTER TABLE results ADD COLUMN scale REAL")
+        db.commit()
+
+        running = True
+        while running:
+            # Wait for the first record, then collect until the batch is full or due
+            batch = [self.records.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.records.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+            if batch:
+                db.executemany(
+                    "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", batch
+                )
+                db.commit()
+        db.close()
+
+
+# Class to save images from a thread pool using write-then-rename, with a disk
+# quota on the failure snapshots
+class ImageWriter:
+    def __init__(self, snapshot_dir, quota_bytes, max_pending=8, max_workers=2):
+        self.snapshot_dir = snapshot_dir
+        self.quota_bytes = quota_bytes
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="image-writer"
+        )
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.dropped = 0
+        self.sequence = 0
+        self.latest = {}  # file path -> sequence of the newest write
+
+        # Existing snapshots count towards the quota, oldest first. A frame and
+        # its difference image are one entry, so they are removed together
+        os.makedirs(snapshot_dir, exist_ok=True)
+        self.snapshots = deque()
+        self.snapshot_bytes = 0
+        groups = {}
+        for entry in os.scandir(snapshot_dir):
+            if entry.is_file():
+                base = entry.path
+                for suffix in ("_diff.png", ".png"):
+                    if base.endswith(suffix):
+                        base = base[: -len(suffix)]
+                        break
+                groups.setdefault(base, []).append(entry)
+        for entries in sorted(
+            groups.values(), key=lambda group: max(e.stat().st_mtime for e in group)
+        ):
+            size = sum(entry.stat().st_size for entry in entries)
+            self.snapshots.append(([entry.path for entry in entries], size))
+            self.snapshot_bytes += size
+
+    def save(self, image, file_path):
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+            self.latest[file_path] = sequence
+            self.pending += 1
+        future = self.executor.submit(self._write, image.copy(), file_path, sequence)
+        future.add_done_callback(self._done)
+
+    def save_reference(self, image, gray, metadata, store_dir, name):
+        os.makedirs(store_dir, exist_ok=True)
+        base = os.path.join(store_dir, name)
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+            self.latest[base] = sequence
+            self.pending += 1
+        future = self.executor.submit(
+            self._write_reference,
+            image.copy(),
+            gray.copy(),
+            metadata,
+            base,
+            sequence,
+        )
+        future.add_done_callback(self._done)
+
+    def save_snapshot(self, frame, diff):
+        # Snapshots are best effort, drop them instead of queueing without bound
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.dropped += 1
+                return
+            self.pending += 1
+        base = os.path.join(self.snapshot_dir, generate_filename("dissimilar", ""))
+        future = self.executor.submit(
+            self._write_snapshot, frame.copy(), diff.copy(), base
+        )
+        future.add_done_callback(self._done)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def _done(self, future):
+        with self.lock:
+            self.pending -= 1
+        if future.exception() is not None:
+            print(f"Failed to save image: {future.exception()}")
+
+    def _write(self, image, file_path, sequence=None):
+        data = cv2.imencode(os.path.splitext(file_path)[1], image)[1].tobytes()
+        return self._write_file(data, file_path, file_path, sequence)
+
+    def _write_file(self, data, file_path, key=None, sequence=None):
+        temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        with self.lock:
+            # A newer save of the same file may have finished first
+            if sequence is not None and self.latest.get(key) != sequence:
+                os.remove(temp_path)
+                return 0
+            os.replace(temp_path, file_path)
+        return len(data)
+
+    def _write_reference(self, image, gray, metadata, base, sequence):
+        for suffix, array in ((".npy", image), ("_gray.npy", gray)):
+            buffer = io.BytesIO()
+            np.save(buffer, array)
+            self._write_file(buffer.getvalue(), f"{base}{suffix}", base, sequence)
+        # The metadata goes last, a reference only counts once it exists
+        data = json.dumps(metadata, indent=4).encode()
+        self._write_file(data, f"{base}.json", base, sequence)
+
+    def _write_snapshot(self, frame, diff, base):
+        file_paths = [f"{base}.png", f"{base}_diff.png"]
+        size = sum(
+            self._write(image, file_path)
+            for file_path, image in zip(file_paths, (frame, diff))
+        )
+
+        with self.lock:
+            self.snapshots.append((file_paths, size))
+            self.snapshot_bytes += size
+            # Remove the oldest snapshots until we are back under the quota
+            while self.snapshot_bytes > self.quota_bytes and self.snapshots:
+                file_paths, size = self.snapshots.popleft()
+                self.snapshot_bytes -= size
+                for file_path in file_paths:
+                    try:
+                        os.remove(file_path)
+                    except FileNotFoundError:
+                        pass
+
+
+# Class to share the latest pipeline state with the HTTP inspection service
+class InspectionState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.latest = {"score": None, "decision": None, "timestamp": None}
+        self.event = None
+        self.event_sequence = 0
+        self.reference = None
+        self.threshold = None
+        self.stations = None
+        self.commands = queue.SimpleQueue()
+
+    def publish(self, result):
+        with self.lock:
+            previous = self.latest["decision"]
+            self.latest = result
+            # Subscribers are woken only when the decision changes
+            if result["decision"] != previous:
+                self.event = dict(result, previous=previous)
+                self.event_sequence += 1
+                self.changed.notify_all()
+
+    def wait_event(self, sequence, timeout):
+        # Events a slow subscriber missed are coalesced into the newest one
+        with self.lock:
+            self.changed.wait_for(lambda: self.event_sequence > sequence, timeout)
+            if self.event_sequence == sequence:
+                return None, sequence, 0
+            missed = self.event_sequence - sequence - 1
+            return dict(self.event), self.event_sequence, missed
+
+    def set_reference(self, image, threshold):
+        with self.lock:
+            self.reference = image
+            self.threshold = threshold
+
+    def publish_stations(self, stations):
+        with self.lock:
+            self.stations = stations
+
+    def snapshot(self):
+        with self.lock:
+            if self.stations is not None:
+                return {"stations": list(self.stations)}
+            return dict(self.latest)
+
+    def request(self, command, payload=None, timeout=5.0):
+        # Hand the command to the main loop and wait for its reply
+        future = Future()
+        self.commands.put((command, payload, future))
+        return future.result(timeout=timeout)
+
+
+# Class to handle HTTP requests for the inspection service
+class InspectionHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/status":
+            status = self.server.state.snapshot()
+            widgets = widget_stats()
+            if widgets is not None:
+                status["widgets"] = widgets
+            if latency_stats is not None:
+                status["latency"] = latency_stats.summary()
+            self._send_json(200, status)
+        elif self.path == "/events":
+            self._stream_events()
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        state = self.server.state
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            self._send_json(400, {"error": "Content-Length is not a number"})
+            return
+        body = self.rfile.read(max(length, 0))
+        if state.stations is not None:
+            # The station workers compare on their own, there is no main loop
+            self._send_json(
+                409, {"error": "Not available with camera stations, use GET /status"}
+            )
+            return
+        try:
+            if self.path == "/compare":
+                self._send_json(200, state.request("compare"))
+            elif self.path == "/reference":
+                image = self._decode_image(body)
+                if image is not None:
+                    self._send_json(200, state.request("reference", image))
+            elif self.path == "/compare-image":
+                image = self._decode_image(body)
+                if image is not None:
+                    result = self._compare_posted(image)
+                    if result is not None:
+                        self._send_json(200, result)
+            else:
+                self._send_json(404, {"error": "Not found"})
+        except TimeoutError:
+            self._send_json(503, {"error": "Pipeline did not respond"})
+
+    def _stream_events(self):
+        # Server-Sent Events, one decision change per message
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        state = self.server.state
+        sequence = state.event_sequence
+        try:
+            while True:
+                event, sequence, missed = state.wait_event(sequence, timeout=15.0)
+                if event is None:
+                    self.wfile.write(b": keep-alive\n\n")
+                else:
+                    event["missed"] = missed
+                    self.wfile.write(
+                        f"id: {sequence}\nevent: decision\n"
+                        f"data: {json.dumps(event)}\n\n".encode()
+                    )
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _compare_posted(self, image):
+        # Runs on the request thread, so the main loop is not held up. Sends the
+        # error itself and returns None when the image can't be compared
+        with self.server.state.lock:
+            reference = self.server.state.reference
+            threshold = self.server.state.threshold
+        if reference is None:
+            return {"error": "No reference image"}
+        if image.shape != reference.shape:
+            # Like the main loop, a different size is refused rather than resized
+            self._send_json(
+                400,
+                {
+                    "error": "Image size does not match the reference",
+                    "reference": list(reference.shape),
+                    "image": list(image.shape),
+                },
+            )
+            return None
+        score, _ = compare_images(reference, image)
+        decision = "Similar" if score >= threshold else "Dissimilar"
+        return {"score": float(score), "decision": decision, "threshold": threshold}
+
+    def _decode_image(self, body):
+        # OpenCV raises on an empty buffer instead of returning None
+        try:
+            image = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+        except cv2.error:
+            image = None
+        if image is None:
+            self._send_json(400, {"error": "Body is not a PNG or JPEG image"})
+        return image
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Polling clients would flood the console otherwise
+        pass
+
+
+# Function to start the HTTP inspection service on a background thread
+def start_inspection_server(state, host, port):
+    server = ThreadingHTTPServer((host, port), InspectionHandler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Inspection service listening on http://{host}:{port}")
+    return server
+
+
+# Class to pace auto-compare so comparisons stay within a CPU budget, trading
+# working resolution for rate when the budget gets tight. With `scaling` off the
+# resolution stays at full size and only the rate adapts
+class CompareRateController:
+    SCALES = (1.0, 0.75, 0.5, 0.25)
+
+    def __init__(self, cpu_share=0.5, max_rate=None, min_rate=2.0, scaling=True):
+        self.cpu_share = cpu_share
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.scaling = scaling
+        self.level = 0
+        self.cost = None  # Smoothed seconds per comparison at the current level
+        self.rate = 0.0
+        self.next_due = 0.0
+
+    @property
+    def scale_factor(self):
+        return self.SCALES[self.level]
+
+    def due(self):
+        return time.monotonic() >= self.next_due
+
+    def record(self, started, finished):
+        duration = finished - started
+        self.cost = duration if self.cost is None else 0.8 * self.cost + 0.2 * duration
+        interval = self.cost / self.cpu_share
+        if self.max_rate:
+            interval = max(interval, 1.0 / self.max_rate)
+        self.rate = 1.0 / interval
+        self.next_due = started + interval
+        if not self.scaling:
+            return
+
+        # Cost follows the pixel count, so predict the rate one level up or down
+        if self.rate < self.min_rate and self.level < len(self.SCALES) - 1:
+            self.level += 1
+            self.cost = None
+        elif self.level > 0:
+            ratio = (self.SCALES[self.level] / self.SCALES[self.level - 1]) ** 2
+            if self.cpu_share / self.cost * ratio > 1.5 * self.min_rate:
+                self.level -= 1
+                self.cost = None
+
+    def describe(self):
+        if self.cost is None:
+            return "Auto Compare Rate : measuring"
+        return (
+            f"Auto Compare Rate : {self.rate:.1f}/s at {self.scale_factor*100:.0f}%"
+            f" ({self.cost*1000:.0f} ms)"
+        )
+
+
+# Class to collect the element updates of a frame and apply them together per
+# window. Updates of the same element are merged and values that are already
+# shown are skipped. On the web backend a window's updates are applied under
+# remi's update lock, so its update thread picks them up in a single pass
+# instead of sending each one as soon as it is made
+class UpdateBatcher:
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.shown = {}
+
+    def _pending(self, window):
+        if window not in self.pending:
+            self.pending[window] = (OrderedDict(), [])
+        return self.pending[window]
+
+    def update(self, window, key, **kwargs):
+        self._pending(window)[0].setdefault(key, {}).update(kwargs)
+
+    def defer(self, window, function, *args):
+        # Direct widget changes and callbacks that belong to the same frame,
+        # called after the window's element updates
+        self._pending(window)[1].append((function, args))
+
+    def flush(self):
+        for window, (updates, calls) in self.pending.items():
+            update_lock = getattr(getattr(window, "App", None), "update_lock", None)
+            with update_lock or contextlib.nullcontext():
+                for key, kwargs in updates.items():
+                    shown = self.shown.setdefault((window, key), {})
+                    changed = {
+                        name: value
+                        for name, value in kwargs.items()
+                        if name not in shown or shown[name] != value
+                    }
+                    if changed:
+                        window[key].update(**changed)
+                        shown.update(changed)
+                for function, args in calls:
+                    function(*args)
+        self.pending.clear()
+
+
+# Class to confirm decisions over several frames. A frame votes "Similar" when
+# its score clears the threshold by half the hysteresis band and "Dissimilar"
+# when it misses by half the band, so scores inside the band vote for the
+# current decision. The last `window` votes are kept in a fixed-size ring buffer
+# and the decision only changes once `votes` of them are against it
+class DecisionDebouncer:
+    def __init__(self, votes=1, window=1, hysteresis=0.0):
+        self.window = max(1, int(window))
+        self.votes = min(max(1, int(votes)), self.window)
+        self.hysteresis = hysteresis
+        self.ring = [False] * self.window
+        self.reset()
+
+    def reset(self):
+        self.decision = None
+        self._clear_votes()
+
+    def _clear_votes(self):
+        self.position = 0
+        self.filled = 0
+        self.passes = 0
+
+    def update(self, score, threshold, zones_passed=True):
+        if self.decision == "Similar":
+            threshold -= self.hysteresis / 2
+        elif self.decision == "Dissimilar":
+            threshold += self.hysteresis / 2
+        vote = bool(zones_passed and score >= threshold)
+
+        if self.filled == self.window:
+            self.passes -= self.ring[self.position]
+        else:
+            self.filled += 1
+        self.ring[self.position] = vote
+        self.passes += vote
+        self.position = (self.position + 1) % self.window
+
+        if self.decision is None:
+            self.decision = "Similar" if vote else "Dissimilar"
+        elif self.decision == "Similar" and self.filled - self.passes >= self.votes:
+            self.decision = "Dissimilar"
+            self._clear_votes()
+        elif self.decision == "Dissimilar" and self.passes >= self.votes:
+            self.decision = "Similar"
+            self._clear_votes()
+        return self.decision
+
+
+# Class to pick the "Dissimilar" frames worth a snapshot: the first one after
+# the decision changes, then at most one every `interval` seconds while it lasts
+class SnapshotThrottle:
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.previous = None
+        self.last_saved = None
+
+    def should_save(self, decision):
+        now = time.monotonic()
+        changed = decision != self.previous
+        self.previous = decision
+        if decision != "Dissimilar":
+            return False
+        if changed or now - self.last_saved >= self.interval:
+            self.last_saved = now
+            return True
+        return False
+
+
+# Class to keep the latency of the last frames at each stage, measured from the
+# frame's capture time, and summarise them as percentiles
+class LatencyStats:
+    def __init__(self, max_samples=500):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, stage, camera_frame):
+        latency = time.monotonic() - camera_frame.timestamp
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.max_samples)
+            self.samples[stage].append(latency)
+        return latency
+
+    def summary(self):
+        # Latencies in milliseconds, safe to call from the HTTP threads
+        with self.lock:
+            samples = {
+                stage: np.array(values) for stage, values in self.samples.items()
+            }
+        summary = {}
+        for stage, values in samples.items():
+            p50, p90, p99 = np.percentile(values, (50, 90, 99)) * 1000
+            summary[stage] = {
+                "p50": round(float(p50), 1),
+                "p90": round(float(p90), 1),
+                "p99": round(float(p99), 1),
+                "max": round(float(values.max()) * 1000, 1),
+                "count": len(values),
+            }
+        return summary
+
+    def describe(self):
+        summary = self.summary()
+        return "Latency p50/p90/p99 : " + (
+            ", ".join(
+                f"{stage} {values['p50']:.0f}/{values['p90']:.0f}/{values['p99']:.0f} ms"
+                for stage, values in summary.items()
+            )
+            or "-"
+        )
+
+
+# Class to keep the encoded display images of the reference in a small LRU,
+# keyed by reference version, scale factor and codec. Zooming back and forth
+# reuses the encoded bytes and a new reference makes the old entries unreachable
+class ReferenceDisplayCache:
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.image = None
+        self.version = 0
+
+    def set_reference(self, image):
+        self.image = image
+        self.version += 1
+
+    def encode(self, scale_factor, codec=".png"):
+        key = (self.version, round(scale_factor, 3), codec)
+        data = self.entries.get(key)
+        if data is None:
+            image = self.image
+            if key[1] != 1.0:
+                image = resize_image(image, key[1])
+            data = cv2.imencode(codec, image)[1].tobytes()
+            self.entries[key] = data
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+        return data
+
+
+# Class to accumulate where differences persist over time, using an exponential
+# moving mean and a decaying max of (1 - SSIM map) so memory stays constant
+class DifferenceHeatmap:
+    def __init__(self, window_frames=100):
+        self.decay = 1.0 / window_frames
+        self.reset()
+
+    def reset(self):
+        self.mean = None
+        self.max = None
+        self.scratch = None
+        self.frames = 0
+
+    def add(self, diff):
+        if self.mean is None or self.mean.shape != diff.shape:
+            self.mean = np.zeros(diff.shape, np.float32)
+            self.max = np.zeros(diff.shape, np.float32)
+            self.scratch = np.empty(diff.shape, np.float32)
+            self.frames = 0
+
+        # The diff holds SSIM * 255, turn it back into dissimilarity in place
+        np.subtract(255.0, diff, out=self.scratch)
+        self.scratch *= 1.0 / 255.0
+
+        self.max *= 1.0 - self.decay
+        np.maximum(self.max, self.scratch, out=self.max)
+        self.scratch -= self.mean
+        self.scratch *= self.decay
+        self.mean += self.scratch
+        self.frames += 1
+
+    def render(self, background=None, peak=False):
+        if self.mean is None:
+            return None
+        source = self.max if peak else self.mean
+        heat = np.clip(source * 255.0, 0, 255).astype("uint8")
+        heat = cv2.applyColorMap(heat, cv2.COLORMAP_JET)
+        if background is not None and background.shape == heat.shape:
+            heat = cv2.addWeighted(background, 0.4, heat, 0.6, 0)
+        return heat
+
+
+# Class to estimate how far the live image moved from the reference with phase
+# correlation on a downsampled image, the reference spectrum is computed once
+class ShiftEstimator:
+    def __init__(self, reference_gray, scale_factor=0.5, min_response=0.1):
+        self.scale_factor = scale_factor
+        self.min_response = min_response
+        small = self._prepare(reference_gray)
+        self.size = (small.shape[1], small.shape[0])
+        self.window = cv2.createHanningWindow(self.size, cv2.CV_32F)
+        self.reference_fft = cv2.dft(small * self.window, flags=cv2.DFT_COMPLEX_OUTPUT)
+
+    def estimate(self, live_gray):
+        small = self._prepare(live_gray)
+        live_fft = cv2.dft(small * self.window, flags=cv2.DFT_COMPLEX_OUTPUT)
+
+        # Normalised cross-power spectrum, its inverse peaks at the shift
+        cross = cv2.mulSpectrums(live_fft, self.reference_fft, 0, conjB=True)
+        real, imaginary = cv2.split(cross)
+        magnitude = cv2.magnitude(real, imaginary)
+        magnitude += 1e-6
+        cross = cv2.merge([real / magnitude, imaginary / magnitude])
+        correlation = cv2.idft(cross, flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)
+        _, response, _, (peak_x, peak_y) = cv2.minMaxLoc(correlation)
+        if response < self.min_response:
+            return 0.0, 0.0, response
+
+        # Refine to sub-pixel with the centroid around the peak
+        width, height = self.size
+        rows = [(peak_y + offset) % height for offset in (-1, 0, 1)]
+        cols = [(peak_x + offset) % width for offset in (-1, 0, 1)]
+        patch = correlation[np.ix_(rows, cols)]
+        total = patch.sum()
+        if total > 0:
+            peak_x += float((patch.sum(axis=0) * (-1, 0, 1)).sum() / total)
+            peak_y += float((patch.sum(axis=1) * (-1, 0, 1)).sum() / total)
+
+        # The correlation wraps around, large shifts are negative ones
+        if peak_x > width / 2:
+            peak_x -= width
+        if peak_y > height / 2:
+            peak_y -= height
+        return peak_x / self.scale_factor, peak_y / self.scale_factor, response
+
+    def _prepare(self, gray):
+        if self.scale_factor < 1.0:
+            gray = resize_image(gray, self.scale_factor)
+        return np.float32(gray)
+
+
+# Class to compare coarse-to-fine on Gaussian pyramids, stopping at the first
+# level where the score is clearly on one side of the threshold. The score
+# comes from the level that decided, so compare also returns that level's scale
+class PyramidComparer:
+    # Coarse levels exaggerate localised defects, rejects need a wider margin
+    REJECT_MARGIN = 4
+
+    def __init__(self, reference_gray, levels=3, margin=0.1):
+        self.margin = margin
+        self.pyramid = [np.ascontiguousarray(reference_gray)]
+        for _ in range(levels):
+            # SSIM needs at least a 7x7 window at the coarsest level
+            if min(self.pyramid[-1].shape[:2]) < 14:
+                break
+            self.pyramid.append(cv2.pyrDown(self.pyramid[-1]))
+        self.exits = [0] * len(self.pyramid)
+        self.detail = self._detail(self.pyramid)
+
+    def compare(self, image, threshold):
+        live_pyramid = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)]
+        for _ in range(len(self.pyramid) - 1):
+            live_pyramid.append(cv2.pyrDown(live_pyramid[-1]))
+
+        # Coarse levels cannot see noise or blur, so only accept early when the
+        # fine detail of the live image looks like the reference's
+        detail = self._detail(live_pyramid)
+        early_accept = abs(detail - self.detail) <= 0.25 * max(self.detail, 1.0)
+
+        # The margin halves at every finer level, full resolution always decides.
+        # A reject only stops once the next finer level rejects as well
+        rejected = False
+        for level in reversed(range(len(self.pyramid))):
+            score, diff = structural_similarity(
+                self.pyramid[level], live_pyramid[level]
+            )
+            margin = self.margin / 2 ** (len(self.pyramid) - 1 - level)
+            if level == 0:
+                break
+            if score < threshold - self.REJECT_MARGIN * margin:
+                if rejected:
+                    break
+                rejected = True
+                continue
+            rejected = False
+            if early_accept and score > threshold + margin:
+                break
+        self.exits[level] += 1
+
+        diff = (np.clip(diff, 0, 1) * 255).astype("uint8")
+        if level > 0:
+            size = (image.shape[1], image.shape[0])
+            diff = cv2.resize(diff, size, interpolation=cv2.INTER_LINEAR)
+        return score, diff, 1 / 2**level
+
+    def _detail(self, pyramid):
+        # Mean absolute band-pass residual between the two finest levels
+        if len(pyramid) < 2:
+            return 0.0
+        size = (pyramid[0].shape[1], pyramid[0].shape[0])
+        return float(
+            cv2.absdiff(pyramid[0], cv2.pyrUp(pyramid[1], dstsize=size)).mean()
+        )
+
+    def describe(self):
+        total = sum(self.exits)
+        if total == 0:
+            return "Pyramid Exits : -"
+        parts = [
+            f"1/{2 ** level}: {count / total * 100:.0f}%"
+            for level, count in reversed(list(enumerate(self.exits)))
+        ]
+        return "Pyramid Exits : " + "  ".join(parts)
+
+
+# Function to crop the live rectangle after following the measured shift
+def align_frame(frame, rect, estimator, max_shift=0.1):
+    live_frame = capture_frame(frame, rect)
+    dx, dy, _ = estimator.estimate(cv2.cvtColor(live_frame, cv2.COLOR_BGR2GRAY))
+    x, y, w, h = rect
+    if abs(dx) > max_shift * w or abs(dy) > max_shift * h:
+        return live_frame, (0, 0)
+
+    # Move the rectangle with the part, staying inside the frame
+    dx = min(max(int(round(dx)), -x), frame.shape[1] - w - x)
+    dy = min(max(int(round(dy)), -y), frame.shape[0] - h - y)
+    return capture_frame(frame, (x + dx, y + dy, w, h)), (dx, dy)
 
 
 # Function to capture the frame inside the rectangle
@@ -24,19 +892,172 @@ def capture_frame(frame, rect):
     return frame[y : y + h, x : x + w]
 
 
+# Function to compute SSIM on uint8 images with OpenCV box filters, matching
+# skimage's defaults (7x7 uniform window, sample covariance). Window sums and
+# the variance numerators are exact in int32, only the final ratio is float32.
+def fast_ssim(image1_gray, image2_gray, win_size=7):
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    n = win_size * win_size
+    window = (win_size, win_size)
+    border = cv2.BORDER_REFLECT
+
+    sx = cv2.boxFilter(
+        image1_gray, cv2.CV_32S, window, normalize=False, borderType=border
+    )
+    sy = cv2.boxFilter(
+        image2_gray, cv2.CV_32S, window, normalize=False, borderType=border
+    )
+    sxx = cv2.sqrBoxFilter(
+        image1_gray, cv2.CV_32S, window, normalize=False, borderType=border
+    )
+    syy = cv2.sqrBoxFilter(
+        image2_gray, cv2.CV_32S, window, normalize=False, borderType=border
+    )
+    xy = cv2.multiply(image1_gray, image2_gray, dtype=cv2.CV_32S)
+    sxy = cv2.boxFilter(xy, cv2.CV_32S, window, normalize=False, borderType=border)
+
+    # n * sum(x^2) - sum(x)^2 stays below 2^31 for 8-bit data and a 7x7 window
+    sx_sy = sx * sy
+    sx_sq = sx * sx
+    sy_sq = sy * sy
+    vx = np.float32(n * sxx - sx_sq)
+    vy = np.float32(n * syy - sy_sq)
+    vxy = np.float32(n * sxy - sx_sy)
+
+    # Same formula as skimage with every term scaled by n^2 or n * (n - 1)
+    means = np.float32(n * n)
+    covariances = np.float32(n * (n - 1))
+    numerator = (2 * np.float32(sx_sy) / means + c1) * (2 * vxy / covariances + c2)
+    denominator = (np.float32(sx_sq + sy_sq) / means + c1) * (
+        (vx + vy) / covariances + c2
+    )
+    ssim_map = numerator / denominator
+
+    # Like skimage, the score ignores the border half a window wide
+    pad = (win_size - 1) // 2
+    score = float(ssim_map[pad:-pad, pad:-pad].mean(dtype=np.float64))
+    return score, ssim_map
+
+
+# Function to compute the SSIM score and map with the configured implementation
+def structural_similarity(image1_gray, image2_gray):
+    if use_fast_ssim:
+        return fast_ssim(image1_gray, image2_gray)
+    return ssim(image1_gray, image2_gray, full=True)
+
+
 # Function to compare the captured image with the live frame inside the rectangle
-def compare_images(image1, image2):
-    # Convert to grayscale for SSIM comparison
-    image1_gray = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
+def compare_images(image1, image2, image1_gray=None, scale_factor=1.0):
+    # Convert to grayscale for SSIM comparison, unless it was precomputed
+    if image1_gray is None:
+        image1_gray = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
     image2_gray = cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY)
 
+    # Work on a reduced resolution when asked to, the diff is scaled back up
+    size = (image2_gray.shape[1], image2_gray.shape[0])
+    if scale_factor < 1.0:
+        image1_gray = resize_image(image1_gray, scale_factor)
+        image2_gray = resize_image(image2_gray, scale_factor)
+
     # Compute SSIM
-    score, diff = ssim(image1_gray, image2_gray, full=True)
-    diff = (diff * 255).astype("uint8")
+    score, diff = structural_similarity(image1_gray, image2_gray)
+    diff = (np.clip(diff, 0, 1) * 255).astype("uint8")
+    if scale_factor < 1.0:
+        diff = cv2.resize(diff, size, interpolation=cv2.INTER_LINEAR)
 
     return score, diff
 
 
+# Function to build the metadata stored next to a reference image
+def reference_metadata(rect, stream_size):
+    return {
+        "roi": list(rect),
+        "stream_size": list(stream_size),
+        "created": datetime.now().isoformat(),
+    }
+
+
+# Function to tell why a stored reference does not fit the current rectangle
+# and stream size, or None when it does
+def reference_mismatch(metadata, rect, stream_size):
+    stored_size = metadata.get("stream_size")
+    if stored_size is not None and list(stored_size) != list(stream_size):
+        return (
+            f"reference was captured at {stored_size[0]}x{stored_size[1]},"
+            f" the stream is {stream_size[0]}x{stream_size[1]}"
+        )
+    stored_roi = metadata.get("roi")
+    if stored_roi is not None and list(stored_roi) != list(rect):
+        return f"reference was captured with rectangle {stored_roi}, now {list(rect)}"
+    return None
+
+
+# Function to load a reference from the store, memory-mapping the pixel data
+def load_reference(store_dir, name):
+    base = os.path.join(store_dir, name)
+    with open(f"{base}.json", "r") as file:
+        metadata = json.load(file)
+    image = np.load(f"{base}.npy", mmap_mode="r")
+    gray = np.load(f"{base}_gray.npy", mmap_mode="r")
+    return image, gray, metadata
+
+
+# Function to read the named zones inside the rectangle from the config
+def read_zones(config):
+    zones = []
+    for number, zone in enumerate(config.get("zones", [])):
+        zones.append(
+            {
+                "name": zone.get("name", f"Zone {number}"),
+                "top": zone.get("top", 0.0),
+                "right": zone.get("right", 1.0),
+                "bottom": zone.get("bottom", 1.0),
+                "left": zone.get("left", 0.0),
+                "threshold": zone.get("threshold"),
+                "weight": zone.get("weight", 1.0),
+            }
+        )
+    return zones
+
+
+# Function to score every zone from the one SSIM map using an integral image
+def score_zones(diff, zones, default_threshold):
+    integral = cv2.integral(diff)
+    height, width = diff.shape[:2]
+    results = []
+    for zone in zones:
+        x1 = min(int(zone["left"] * width), width - 1)
+        y1 = min(int(zone["top"] * height), height - 1)
+        x2 = min(max(int(zone["right"] * width), x1 + 1), width)
+        y2 = min(max(int(zone["bottom"] * height), y1 + 1), height)
+        total = (
+            integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+        )
+        score = total / ((x2 - x1) * (y2 - y1) * 255.0)
+        threshold = zone["threshold"]
+        if threshold is None:
+            threshold = default_threshold
+        results.append(
+            {
+                "name": zone["name"],
+                "score": float(score),
+                "threshold": threshold,
+                "weight": zone["weight"],
+                "passed": bool(score >= threshold),
+            }
+        )
+    return results
+
+
+# Function to combine zone scores into one weighted score
+def weighted_zone_score(zone_results):
+    total_weight = sum(zone["weight"] for zone in zone_results)
+    if total_weight <= 0:
+        return None
+    return sum(zone["score"] * zone["weight"] for zone in zone_results) / total_weight
+
+
 # Function to read configuration from JSON file
 def read_config(file_path):
     default_config = {"top": 0.2, "right": 0.8, "bottom": 0.8, "left": 0.2}
@@ -57,7 +1078,7 @@ def write_config(file_path, config):
 
 # Function to generate a unique filename
 def generate_filename(prefix="capture", ext=".png"):
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
     return f"{prefix}_{timestamp}{ext}"
 
 
@@ -68,18 +1089,566 @@ def resize_image(image, scale_factor):
     return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
 
 
+# Function to check whether a raw buffer from the camera holds JPEG data
+def is_jpeg_buffer(data):
+    return (
+        data is not None
+        and data.ndim <= 2
+        and data.size > 2
+        and data.reshape(-1)[0] == 0xFF
+        and data.reshape(-1)[1] == 0xD8
+    )
+
+
+# Function to read the next frame from the camera, keeping MJPEG data compressed
+def read_frame(cap):
+    # Without a single-buffer queue, drop the queued frames before decoding one
+    if use_latest_frame and cap.get(cv2.CAP_PROP_BUFFERSIZE) != 1:
+        ret = grab_latest(cap)
+        if ret:
+            ret, data = cap.retrieve()
+    else:
+        ret, data = cap.read()
+    read_at = time.monotonic()
+    if not ret:
+        return None
+
+    # V4L2 reports the driver's buffer timestamp, taken on the same monotonic
+    # clock when the sensor delivered the frame. Other backends report a stream
+    # position instead, those frames are stamped when read() returns
+    timestamp = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+    if not 0.0 <= read_at - timestamp < 2.0:
+        timestamp = read_at
+    if is_jpeg_buffer(data):
+        return CameraFrame(jpeg=data.reshape(-1), timestamp=timestamp)
+    return CameraFrame(image=data, timestamp=timestamp)
+
+
+# Function to grab frames until the newest one, without decoding the ones skipped
+def grab_latest(cap):
+    frame_interval = 1.0 / (cap.get(cv2.CAP_PROP_FPS) or 30.0)
+    for _ in range(MAX_DRAIN_GRABS):
+        started = time.monotonic()
+        if not cap.grab():
+            return False
+        grabbed_at = time.monotonic()
+
+        # A frame is fresh when its buffer timestamp is within one frame
+        # interval, or without a timestamp when grab() had to wait for it
+        timestamp = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        if 0.0 <= grabbed_at - timestamp < 2.0:
+            fresh = grabbed_at - timestamp < frame_interval
+        else:
+            fresh = grabbed_at - started > frame_interval / 2
+        if fresh:
+            break
+    return True
+
+
+# Function to open a camera, negotiating MJPEG when enabled
+def open_camera(camera_index):
+    cap = cv2.VideoCapture(camera_index)
+    if use_mjpeg:
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, stream_width)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, stream_height)
+    if use_latest_frame:
+        # Backends that ignore this are drained by read_frame instead
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    if use_mjpeg and cap.isOpened():
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+        fourcc = "".join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4))
+        if fourcc == "MJPG":
+            # Ask V4L2 for the compressed buffer instead of a BGR image, other
+            # backends do not hand out the raw JPEG data reliably
+            if cap.getBackendName() == "V4L2":
+                cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+                ret, data = cap.read()
+                if not ret or not is_jpeg_buffer(data):
+                    cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+            print(f"Camera {camera_index} streaming MJPEG.")
+        else:
+            print(f"Camera {camera_index} does not support MJPEG, using {fourcc}.")
+    return cap
+
+
+# Class to open and close cameras on a background thread, optionally keeping
+# recently used cameras open so switching back to them is instant
+class CameraSwitcher:
+    def __init__(self, camera_index, warm_cameras=0):
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="camera-switch"
+        )
+        self.warm_cameras = warm_cameras
+        self.warm = OrderedDict()  # camera index -> open capture, oldest first
+        self.pending = None  # (camera index, future of the opened capture)
+        self.failed = False
+        self.camera_index = camera_index
+        self.cap = open_camera(camera_index)
+
+    @property
+    def switching(self):
+        return self.pending is not None
+
+    def request(self, camera_index):
+        if self.pending is not None:
+            # Superseded, release the camera once it has finished opening
+            self.pending[1].add_done_callback(lambda future: future.result().release())
+            self.pending = None
+        if camera_index == self.camera_index:
+            return
+
+        self.failed = False
+        if camera_index in self.warm:
+            cap = self.warm.pop(camera_index)
+            if (
+                int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) == stream_width
+                and int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) == stream_height
+            ):
+                self._park()
+                self.camera_index = camera_index
+                self.cap = cap
+                return
+            future = self.executor.submit(self._resize, cap)
+        else:
+            future = self.executor.submit(open_camera, camera_index)
+        self.pending = (camera_index, future)
+
+    def poll(self):
+        # Swap in the new camera once it is open, keep using the old one until then
+        if self.pending is not None and self.pending[1].done():
+            camera_index, future = self.pending
+            self.pending = None
+            cap = future.result()
+            if cap.isOpened():
+                self._park()
+                self.camera_index = camera_index
+                self.cap = cap
+            else:
+                print(f"Camera {camera_index} is not available.")
+                self.failed = True
+                self.executor.submit(cap.release)
+        return self.cap
+
+    def close(self):
+        self.cap.release()
+        for cap in self.warm.values():
+            cap.release()
+        self.executor.shutdown(wait=True)
+
+    def _park(self):
+        if self.warm_cameras > 0:
+            self.warm[self.camera_index] = self.cap
+            while len(self.warm) > self.warm_cameras:
+                self.executor.submit(self.warm.popitem(last=False)[1].release)
+        else:
+            self.executor.submit(self.cap.release)
+
+    def _resize(self, cap):
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, stream_width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, stream_height)
+        return cap
+
+
+# Function to build the live preview image with the rectangle drawn on it
+def render_preview(camera_frame, rect, frame_size, scale_factor):
+    width = int(frame_size[0] * scale_factor)
+    height = int(frame_size[1] * scale_factor)
+    preview = cv2.resize(
+        camera_frame.image(scale_factor),
+        (width, height),
+        interpolation=cv2.INTER_AREA,
+    )
+    rect_x, rect_y, rect_w, rect_h = (int(v * scale_factor) for v in rect)
+    cv2.rectangle(
+        preview, (rect_x, rect_y), (rect_x + rect_w, rect_y + rect_h), (0, 255, 0), 2
+    )
+    return preview
+
+
+# Function to put a rectangle overlay on top of the web preview image
+def attach_roi_overlay(image_element):
+    import remi.gui
+
+    image = image_element.Widget
+    parent = image.get_parent()
+    parent.remove_child(image)
+    wrapper = remi.gui.Container(
+        style={"position": "relative", "display": "inline-block"}
+    )
+    image.style["display"] = "block"
+    wrapper.append(image)
+    overlay = remi.gui.Widget(
+        style={
+            "position": "absolute",
+            "border": "2px solid #00ff00",
+            "box-sizing": "border-box",
+            "pointer-events": "none",
+        }
+    )
+    wrapper.append(overlay)
+    parent.append(wrapper)
+    return overlay
+
+
+# Function to move the rectangle overlay, positioned in percent of the preview
+def update_roi_overlay(overlay, top, right, bottom, left, visible=True):
+    overlay.style["display"] = "block" if visible else "none"
+    overlay.style["left"] = f"{left * 100:.2f}%"
+    overlay.style["top"] = f"{top * 100:.2f}%"
+    overlay.style["width"] = f"{(right - left) * 100:.2f}%"
+    overlay.style["height"] = f"{(bottom - top) * 100:.2f}%"
+
+
+# Function to read the widget registry counters of the patched remi (archive/gui.py)
+def widget_stats():
+    if sg.__name__ not in JPEG_PREVIEW_BACKENDS:
+        return None
+    import remi.gui
+
+    if not hasattr(remi.gui, "runtime_instances_stats"):
+        return None
+    return remi.gui.runtime_instances_stats()
+
+
+# Function to flush and stop the background services
+def close_services():
+    if results_log is not None:
+        results_log.close()
+        print("Results log flushed")
+    if image_writer is not None:
+        image_writer.close()
+        print("Pending images saved")
+    if inspection_server is not None:
+        inspection_server.shutdown()
+        print("Inspection service stopped")
+
+
+# Function to inspect one camera station in a worker process
+def camera_worker(station, results, stop, commands):
+    global stream_width
+    global stream_height
+    global use_mjpeg
+    global use_fast_ssim
+    global use_latest_frame
+
+    # One core per station, OpenCV's own thread pool would compete across workers
+    cv2.setNumThreads(1)
+    stream_width = station.get("width", stream_width)
+    stream_height = station.get("height", stream_height)
+    use_mjpeg = station.get("mjpeg", use_mjpeg)
+    use_fast_ssim = station.get("fast_ssim", use_fast_ssim)
+    use_latest_frame = station.get("latest_frame", use_latest_frame)
+    name = station["name"]
+
+    try:
+        reference, reference_gray, _ = load_reference(
+            station["reference_store"], station["reference"]
+        )
+    except (FileNotFoundError, ValueError, json.JSONDecodeError):
+        # Keep the camera running so a reference can be captured from it
+        reference = reference_gray = None
+    status = None
+
+    zones = read_zones(station)
+    debouncer = DecisionDebouncer(
+        station["decision_votes"],
+        station["decision_window"],
+        station["decision_hysteresis"],
+    )
+    cap = open_camera(station["camera"])
+    last_time = time.monotonic()
+    rate = 0.0
+    while not stop.is_set():
+        camera_frame = read_frame(cap)
+        if camera_frame is None:
+            # A camera that drops out is reopened rather than given up on
+            status = "Camera read failed, reopening"
+            results.put({"station": name, "error": status})
+            cap.release()
+            stop.wait(1.0)
+            cap = open_camera(station["camera"])
+            continue
+
+        frame = camera_frame.image()
+        frame_height, frame_width = frame.shape[:2]
+        rect = (
+            int(station["left"] * frame_width),
+            int(station["top"] * frame_height),
+            int((station["right"] - station["left"]) * frame_width),
+            int((station["bottom"] - station["top"]) * frame_height),
+        )
+        live_frame = capture_frame(frame, rect)
+
+        # The main process stores captured references, workers only hold them
+        try:
+            command = commands.get_nowait()
+        except queue.Empty:
+            command = None
+        if command == "capture":
+            reference = live_frame.copy()
+            reference_gray = cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY)
+            debouncer = DecisionDebouncer(
+                station["decision_votes"],
+                station["decision_window"],
+                station["decision_hysteresis"],
+            )
+            results.put(
+                {
+                    "station": name,
+                    "reference": reference,
+                    "gray": reference_gray,
+                    "metadata": reference_metadata(rect, (frame_width, frame_height)),
+                }
+            )
+
+        if reference is None:
+            message = "No reference, press Capture Reference"
+        elif live_frame.shape != reference.shape:
+            message = "Reference size mismatch, press Capture Reference"
+        else:
+            message = None
+        if message is not None:
+            # Reported once, the worker keeps reading until a reference is captured
+            if message != status:
+                status = message
+                results.put({"station": name, "error": status})
+            continue
+        status = None
+
+        score, diff = compare_images(reference, live_frame, reference_gray)
+        zone_results = score_zones(diff, zones, station["threshold"])
+        decision = debouncer.update(
+            score,
+            station["threshold"],
+            all(zone["passed"] for zone in zone_results),
+        )
+
+        now = time.monotonic()
+        rate = 0.9 * rate + 0.1 / max(now - last_time, 1e-6)
+        last_time = now
+        try:
+            results.put_nowait(
+                {
+                    "station": name,
+                    "camera": station["camera"],
+                    "rect": rect,
+                    "score": float(score),
+                    "zone_score": weighted_zone_score(zone_results),
+                    "decision": decision,
+                    "threshold": station["threshold"],
+                    "rate": rate,
+                    "timestamp": time.time(),
+                    "latency_ms": round(
+                        (time.monotonic() - camera_frame.timestamp) * 1000, 1
+                    ),
+                }
+            )
+        except queue.Full:
+            pass
+    cap.release()
+
+
+# Class to run one comparison worker process per camera station
+class StationOrchestrator:
+    def __init__(self, stations):
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue(maxsize=1000)
+        self.stop_event = context.Event()
+        self.commands = [context.Queue() for _ in stations]
+        self.latest = {station["name"]: {} for station in stations}
+        self.workers = [
+            context.Process(
+                target=camera_worker,
+                args=(station, self.results, self.stop_event, commands),
+                daemon=True,
+            )
+            for station, commands in zip(stations, self.commands)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def poll(self):
+        # Collect everything the workers produced since the last call
+        results = []
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if "reference" not in result:
+                self.latest[result["station"]] = result
+            results.append(result)
+        return results
+
+    def capture(self, index):
+        # The worker replies with the reference on the results queue
+        self.commands[index].put("capture")
+
+    def stop(self):
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+
+# Function to build the station list from the cameras section of the config
+def read_stations(config):
+    stations = []
+    for number, camera in enumerate(config["cameras"]):
+        station = {
+            "name": f"Station {number}",
+            "camera": number,
+            "reference": f"station_{number}",
+            "reference_store": config.get("reference_store", "references"),
+            "threshold": similarity_threshold,
+            "zones": config.get("zones", []),
+            "mjpeg": config.get("mjpeg", use_mjpeg),
+            "fast_ssim": config.get("fast_ssim", use_fast_ssim),
+            "latest_frame": config.get("latest_frame", use_latest_frame),
+            "decision_votes": config.get("decision_votes", 1),
+            "decision_window": config.get("decision_window", 1),
+            "decision_hysteresis": config.get("decision_hysteresis", 0.0),
+        }
+        for key, default in (
+            ("top", 0.2),
+            ("right", 0.8),
+            ("bottom", 0.8),
+            ("left", 0.2),
+        ):
+            station[key] = config.get(key, default)
+        station.update(camera)
+        stations.append(station)
+    return stations
+
+
+# Function to show the shared results view while the station workers run
+def run_stations(config):
+    stations = read_stations(config)
+    orchestrator = StationOrchestrator(stations)
+    if inspection_state is not None:
+        inspection_state.publish_stations([])
+    headings = ["Station", "Camera", "Similarity", "Decision", "Rate"]
+    stations_window = sg.Window(
+        "Stations",
+        [
+            [
+                sg.Button("Quit App", key="-QUIT-"),
+                sg.Button("Capture Reference", key="-STATION-CAPTURE-"),
+                sg.Text("", key="-STATION-STATUS-", size=(40, 1)),
+            ],
+            [
+                sg.Table(
+                    values=[],
+                    headings=headings,
+                    key="-STATIONS-",
+                    num_rows=max(len(stations), 4),
+                    auto_size_columns=False,
+                    col_widths=[12, 8, 12, 36, 8],
+                    select_mode=sg.TABLE_SELECT_MODE_EXTENDED,
+                )
+            ],
+        ],
+        location=(0, 0),
+    )
+
+    try:
+        while True:
+            event, values = stations_window.read(timeout=50)
+            if event == sg.WIN_CLOSED or event == "-QUIT-":
+                break
+            if event == "-STATION-CAPTURE-":
+                # The current rectangle of each selected station becomes its reference
+                selected = values["-STATIONS-"]
+                for index in selected:
+                    orchestrator.capture(index)
+                stations_window["-STATION-STATUS-"].update(
+                    "Capturing..." if selected else "Select a station first"
+                )
+
+            for result in orchestrator.poll():
+                if "reference" in result:
+                    station = next(
+                        s for s in stations if s["name"] == result["station"]
+                    )
+                    image_writer.save_reference(
+                        result["reference"],
+                        result["gray"],
+                        result["metadata"],
+                        station["reference_store"],
+                        station["reference"],
+                    )
+                    stations_window["-STATION-STATUS-"].update(
+                        f"Reference captured for {station['name']}"
+                    )
+                elif "error" in result:
+                    print(f"{result['station']}: {result['error']}")
+                elif results_log is not None:
+                    results_log.record(
+                        result["camera"],
+                        result["rect"],
+                        result["score"],
+                        result["decision"],
+                        result["threshold"],
+                    )
+
+            rows = []
+            for station in stations:
+                result = orchestrator.latest[station["name"]]
+                if "score" in result:
+                    rows.append(
+                        [
+                            station["name"],
+                            station["camera"],
+                            f"{result['score'] * 100:.2f}%",
+                            result["decision"],
+                            f"{result['rate']:.1f}/s",
+                        ]
+                    )
+                else:
+                    status = result.get("error", "Starting")
+                    rows.append([station["name"], station["camera"], "", status, ""])
+            # Refilling the table clears the selection, so it is put back
+            stations_window["-STATIONS-"].update(
+                values=rows, select_rows=values["-STATIONS-"]
+            )
+            if inspection_state is not None:
+                inspection_state.publish_stations(
+                    [
+                        dict(orchestrator.latest[station["name"]], name=station["name"])
+                        for station in stations
+                    ]
+                )
+    finally:
+        orchestrator.stop()
+        stations_window.close()
+
+
 # Function to handle video capture and drawing
 def video_capture():
     global captured_image
+    global captured_gray
+    global shift_estimator
+    global pyramid_comparer
     global window
     global color_window
     global cap
+    global results_log
+    global image_writer
+    global inspection_state
+    global inspection_server
+    global latency_stats
     global similarity_threshold
     global auto_compare
     global diff_scale_factor
     global live_scale_factor
     global stream_width
     global stream_height
+    global use_mjpeg
+    global use_fast_ssim
+    global use_latest_frame
 
     # Read configuration
     config = read_config("config.json")
@@ -87,18 +1656,72 @@ def video_capture():
     right = config.get("right", 0.8)
     bottom = config.get("bottom", 0.8)
     left = config.get("left", 0.2)
+    use_mjpeg = config.get("mjpeg", use_mjpeg)
+    use_fast_ssim = config.get("fast_ssim", use_fast_ssim)
+    use_latest_frame = config.get("latest_frame", use_latest_frame)
+    results_log_path = config.get("results_log", "results.db")
+    if results_log_path:
+        results_log = ResultsLog(results_log_path)
+    save_failures = config.get("save_failures", True)
+    snapshot_throttle = SnapshotThrottle(config.get("snapshot_interval", 5.0))
+    zones = read_zones(config)
+    image_writer = ImageWriter(
+        config.get("snapshot_dir", "snapshots"),
+        int(config.get("snapshot_quota_mb", 100) * 1024 * 1024),
+    )
+    inspection_state = InspectionState()
+    latency_stats = LatencyStats()
+    if config.get("http_port"):
+        inspection_server = start_inspection_server(
+            inspection_state,
+            config.get("http_host", "127.0.0.1"),
+            int(config["http_port"]),
+        )
 
-    # Read captured image if it exists and is not empty
-    if (
-        os.path.exists("captured_image.png")
-        and os.path.getsize("captured_image.png") > 0
-    ):
-        captured_image = cv2.imread("captured_image.png")
-        print("Captured image loaded successfully.")
-    else:
-        captured_image = cv2.imread("sample/sample_capture.png")
-        print("No captured image found or file is empty.")
-        print("Loaded sample image for comparison.")
+    # Several cameras are inspected by worker processes with a shared view
+    if config.get("cameras"):
+        run_stations(config)
+        close_services()
+        return
+
+    # Prefer the memory-mapped reference store over decoding a PNG
+    reference_store = config.get("reference_store", "references")
+    reference_name = config.get("reference", "reference")
+    try:
+        captured_image, captured_gray, metadata = load_reference(
+            reference_store, reference_name
+        )
+        print("Reference loaded from store.")
+    except (FileNotFoundError, ValueError, json.JSONDecodeError):
+        captured_image = None
+        metadata = None
+
+    # Otherwise read captured image if it exists and is not empty
+    if captured_image is None:
+        if (
+            os.path.exists("captured_image.png")
+            and os.path.getsize("captured_image.png") > 0
+        ):
+            captured_image = cv2.imread("captured_image.png")
+            print("Captured image loaded successfully.")
+        else:
+            captured_image = cv2.imread("sample/sample_capture.png")
+            print("No captured image found or file is empty.")
+            print("Loaded sample image for comparison.")
+        captured_gray = cv2.cvtColor(captured_image, cv2.COLOR_BGR2GRAY)
+    inspection_state.set_reference(captured_image, similarity_threshold)
+
+    # Optional registration stage to follow small camera shifts
+    registration = config.get("registration", False)
+    registration_scale = config.get("registration_scale", 0.5)
+    if registration:
+        shift_estimator = ShiftEstimator(captured_gray, registration_scale)
+
+    # Optional coarse-to-fine comparison with early exit
+    pyramid = config.get("pyramid", False)
+    pyramid_margin = config.get("pyramid_margin", 0.1)
+    if pyramid:
+        pyramid_comparer = PyramidComparer(captured_gray, margin=pyramid_margin)
 
     layout = [
         [
@@ -151,6 +1774,7 @@ def video_capture():
                                         readonly=True,
                                     ),
                                     sg.Button("Apply Camera", key="-APPLY-CAMERA-"),
+                                    sg.Text("", key="-CAMERA-STATUS-", size=(14, 1)),
                                 ],
                                 [
                                     sg.Text("Top"),
@@ -218,6 +1842,29 @@ def video_capture():
                                         font=("Helvetica", 16),
                                     ),
                                 ],
+                                [
+                                    sg.Text(
+                                        "Auto Compare Rate : off",
+                                        key="-RATE-",
+                                        font=("Helvetica", 12),
+                                    ),
+                                ],
+                                [
+                                    sg.Text(
+                                        "Latency p50/p90/p99 : -",
+                                        key="-LATENCY-",
+                                        font=("Helvetica", 12),
+                                        size=(60, 1),
+                                    ),
+                                ],
+                                [
+                                    sg.Text(
+                                        "Pyramid Exits : -",
+                                        key="-PYRAMID-",
+                                        font=("Helvetica", 12),
+                                        visible=pyramid,
+                                    ),
+                                ],
                                 [
                                     sg.Text(
                                         "Similarity Decision: ",
@@ -226,6 +1873,15 @@ def video_capture():
                                         background_color="red",
                                     ),
                                 ],
+                                [
+                                    sg.Text(
+                                        "",
+                                        key="-ZONES-",
+                                        font=("Helvetica", 12),
+                                        size=(40, len(zones) + 1),
+                                        visible=bool(zones),
+                                    ),
+                                ],
                                 [
                                     sg.Text("Similarity Threshold"),
                                     sg.Slider(
@@ -275,6 +1931,14 @@ def video_capture():
                                         key="-AUTO-COMPARE-",
                                     ),
                                 ],
+                                [
+                                    sg.Button(
+                                        "Show Heatmap", key="-HEATMAP-", size=(20, 1)
+                                    ),
+                                    sg.Button(
+                                        "Show Peak", key="-HEATMAP-PEAK-", size=(10, 1)
+                                    ),
+                                ],
                             ],
                         ),
                     ],
@@ -316,6 +1980,12 @@ def video_capture():
                     [sg.Text("Current Frame")],
                 ]
             ),
+            sg.Column(
+                [
+                    [sg.Image(filename="", key="-HEATMAP-IMAGE-")],
+                    [sg.Text("Difference Heatmap")],
+                ]
+            ),
         ],
     ]
 
@@ -337,52 +2007,211 @@ def video_capture():
     color_window = sg.Window(
         "Similarity Color", color_layout, location=(300, 0)
     )  # Adjust location as needed
+    gui_updates = UpdateBatcher()
+    reference_display = ReferenceDisplayCache()
+    reference_display.set_reference(captured_image)
 
     # Initialize Setup
     event, values = window.read(timeout=20)
     if capture_frame is not None:
-        window["-CAPTURED-"].update(
-            data=cv2.imencode(".png", captured_image)[1].tobytes()
-        )
+        gui_updates.update(window, "-CAPTURED-", data=reference_display.encode(1.0))
 
-    def run_comparison():
+    def run_comparison(scale_factor=1.0):
         if captured_image is not None:
-            live_frame = capture_frame(frame, rect)
-            score, diff_image = compare_images(captured_image, live_frame)
+            if shift_estimator is not None:
+                live_frame, shift = align_frame(
+                    camera_frame.image(), rect, shift_estimator
+                )
+            else:
+                live_frame = capture_frame(camera_frame.image(), rect)
+                shift = (0, 0)
+
+            # A reference from another rectangle or stream size can't be compared
+            if live_frame.shape != captured_image.shape:
+                gui_updates.update(
+                    window,
+                    "-DECISION-",
+                    value="Similarity Decision: capture a new reference",
+                    background_color="red",
+                )
+                return {
+                    "error": "Reference size does not match the rectangle,"
+                    " capture a new reference"
+                }
+            if pyramid_comparer is not None:
+                score, diff_image, scale_factor = pyramid_comparer.compare(
+                    live_frame, similarity_threshold
+                )
+            else:
+                score, diff_image = compare_images(
+                    captured_image, live_frame, captured_gray, scale_factor
+                )
             similarity_percentage = score * 100
             diff_image_resized = resize_image(diff_image, diff_scale_factor)
             live_frame_resized = resize_image(live_frame, diff_scale_factor)
             diff_imgbytes = cv2.imencode(".png", diff_image_resized)[1].tobytes()
             live_imgbytes = cv2.imencode(".png", live_frame_resized)[1].tobytes()
-            window["-CURRENTFRAME-"].update(data=live_imgbytes)
-            window["-DIFF-"].update(data=diff_imgbytes)
-            window["-SSIM-"].update(
-                f"Similarity               : {similarity_percentage:.2f}%"
+            gui_updates.update(window, "-CURRENTFRAME-", data=live_imgbytes)
+            gui_updates.update(window, "-DIFF-", data=diff_imgbytes)
+            gui_updates.update(
+                window,
+                "-SSIM-",
+                value=f"Similarity               : {similarity_percentage:.2f}%"
+                + (f" at {scale_factor*100:.0f}%" if scale_factor < 1.0 else ""),
             )
 
-            # Determine similarity decision
-            decision = "Similar" if score >= similarity_threshold else "Dissimilar"
-            color = "green" if score >= similarity_threshold else "red"
-            window["-DECISION-"].update(f"Similarity Decision: {decision}")
-            window["-DECISION-"].update(background_color=color)
+            # Score the zones from the same map, every zone has to pass as well
+            zone_results = score_zones(diff_image, zones, similarity_threshold)
+            if zone_results:
+                zone_lines = [
+                    f"{zone['name']}: {zone['score']*100:.2f}%"
+                    f" {'ok' if zone['passed'] else 'FAIL'}"
+                    for zone in zone_results
+                ]
+                zone_score = weighted_zone_score(zone_results)
+                if zone_score is not None:
+                    zone_lines.append(f"Weighted zones: {zone_score*100:.2f}%")
+                gui_updates.update(window, "-ZONES-", value="\n".join(zone_lines))
+
+            # Determine similarity decision, confirmed over the last frames
+            decision = debouncer.update(
+                score,
+                similarity_threshold,
+                all(zone["passed"] for zone in zone_results),
+            )
+            latency = latency_stats.record("decision", camera_frame)
+            color = "green" if decision == "Similar" else "red"
+            gui_updates.update(
+                window,
+                "-DECISION-",
+                value=f"Similarity Decision: {decision}",
+                background_color=color,
+            )
 
             # Update color window
-            color_window["-COLOR-BLOCK-"].update(background_color=color)
-            color_window["-COLOR-TEXT-"].update(f"Similarity Color: {color}")
+            gui_updates.update(color_window, "-COLOR-BLOCK-", background_color=color)
+            gui_updates.update(
+                color_window, "-COLOR-TEXT-", value=f"Similarity Color: {color}"
+            )
+            # The frame reaches the screen once the colour window is updated
+            gui_updates.defer(
+                color_window, latency_stats.record, "screen", camera_frame
+            )
+
+            if results_log is not None:
+                results_log.record(
+                    camera_index,
+                    rect,
+                    score,
+                    decision,
+                    similarity_threshold,
+                    scale_factor,
+                )
+            heatmap.add(diff_image)
+            if save_failures and snapshot_throttle.should_save(decision):
+                image_writer.save_snapshot(live_frame, diff_image)
+
+            result = {
+                "score": float(score),
+                "scale": scale_factor,
+                "decision": decision,
+                "threshold": similarity_threshold,
+                "camera": camera_index,
+                "timestamp": time.time(),
+                "zones": zone_results,
+                "shift": shift,
+                "zone_score": weighted_zone_score(zone_results),
+                "latency_ms": round(latency * 1000, 1),
+            }
+            inspection_state.publish(result)
+            return result
 
         else:
             print("No image captured for comparison.")
+            return {"error": "No reference image"}
+
+    def set_reference(image):
+        global captured_image
+        global captured_gray
+        global shift_estimator
+        global pyramid_comparer
+
+        captured_image = image
+        captured_gray = cv2.cvtColor(captured_image, cv2.COLOR_BGR2GRAY)
+        if registration:
+            shift_estimator = ShiftEstimator(captured_gray, registration_scale)
+        if pyramid:
+            pyramid_comparer = PyramidComparer(captured_gray, margin=pyramid_margin)
+        heatmap.reset()
+        debouncer.reset()
+        inspection_state.set_reference(captured_image, similarity_threshold)
+        reference_display.set_reference(captured_image)
+        gui_updates.update(
+            window, "-CAPTURED-", data=reference_display.encode(diff_scale_factor)
+        )
+        print("Image Captured!")
+
+        # Save the captured image to a file in the background
+        filename = "captured_image.png"
+        image_writer.save(captured_image, filename)
+        print(f"Saving image as {filename}")
+        image_writer.save_reference(
+            captured_image,
+            captured_gray,
+            reference_metadata(rect, (frame_width, frame_height)),
+            reference_store,
+            reference_name,
+        )
+
+    # Forward the camera's JPEG bytes to the preview when the backend can show them
+    roi_overlay = None
+    if sg.__name__ in JPEG_PREVIEW_BACKENDS:
+        roi_overlay = attach_roi_overlay(window["-IMAGE-"])
 
     # Default camera
-    cap = cv2.VideoCapture(0)
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, stream_width)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, stream_height)
+    camera_switcher = CameraSwitcher(0, config.get("warm_cameras", 0))
+    camera_index = camera_switcher.camera_index
+    cap = camera_switcher.cap
+
+    # A stored reference is checked against the size the camera really delivers
+    if metadata is not None:
+        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        mismatch = reference_mismatch(
+            metadata,
+            (
+                int(left * frame_width),
+                int(top * frame_height),
+                int((right - left) * frame_width),
+                int((bottom - top) * frame_height),
+            ),
+            (frame_width, frame_height),
+        )
+        if mismatch is not None:
+            print(f"Warning: {mismatch}, capture a new reference.")
+    rate_controller = CompareRateController(
+        config.get("compare_cpu_share", 0.5),
+        config.get("compare_max_rate"),
+        config.get("compare_min_rate", 2.0),
+        # The pyramid picks its own resolution and ignores the scale factor
+        scaling=not pyramid,
+    )
+    rate_shown_at = 0.0
+    latency_shown_at = 0.0
+    heatmap = DifferenceHeatmap(config.get("heatmap_window", 100))
+    debouncer = DecisionDebouncer(
+        config.get("decision_votes", 1),
+        config.get("decision_window", 1),
+        config.get("decision_hysteresis", 0.0),
+    )
 
     while True:
         event, values = window.read(timeout=20)
         color_event, color_values = color_window.read(timeout=20)
-        ret, frame = cap.read()
-        if not ret:
+        cap = camera_switcher.poll()
+        camera_index = camera_switcher.camera_index
+        camera_frame = read_frame(cap)
+        if camera_frame is None:
             break
 
         # Update rectangle dimensions based on user input
@@ -403,24 +2232,33 @@ def video_capture():
         # Update similarity threshold live
         if event == "-THRESHOLD-":
             similarity_threshold = float(values["-THRESHOLD-"])
-            window["-CURRENT-THRESHOLD-"].update(
-                f"Current Threshold : {similarity_threshold*100:.2f}%"
+            inspection_state.set_reference(captured_image, similarity_threshold)
+            gui_updates.update(
+                window,
+                "-CURRENT-THRESHOLD-",
+                value=f"Current Threshold : {similarity_threshold*100:.2f}%",
             )
 
         # Update camera based on user input
         if event == "-APPLY-CAMERA-":
             selected_camera = values["-CAMERA-"]
-            camera_index = 0 if selected_camera == "Camera 0" else 1
-            cap.release()
-            cap = cv2.VideoCapture(camera_index)
-            cap.set(cv2.CAP_PROP_FRAME_WIDTH, stream_width)
-            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, stream_height)
+            camera_switcher.request(0 if selected_camera == "Camera 0" else 1)
+
+        # Show whether a camera is still being opened in the background
+        if camera_switcher.switching:
+            status = "Switching..."
+        elif camera_switcher.failed:
+            status = "Not available"
+        else:
+            status = ""
+        gui_updates.update(window, "-CAMERA-STATUS-", value=status)
 
         # Handle scaling events
+        # The difference scale is rounded so zoom levels repeat exactly
         if event == "-DIFF-PLUS-":
-            diff_scale_factor += 0.1
+            diff_scale_factor = round(diff_scale_factor + 0.1, 1)
         if event == "-DIFF-MINUS-":
-            diff_scale_factor = max(0.1, diff_scale_factor - 0.1)
+            diff_scale_factor = max(0.1, round(diff_scale_factor - 0.1, 1))
         if event == "-LIVEFRAME-PLUS-":
             live_scale_factor += 0.1
         if event == "-LIVEFRAME-MINUS-":
@@ -429,11 +2267,11 @@ def video_capture():
         # Update the captured image if it exists
         if event == "-DIFF-PLUS-" or event == "-DIFF-MINUS-":
             if captured_image is not None:
-                captured_image_resized = resize_image(captured_image, diff_scale_factor)
-                captured_imgbytes = cv2.imencode(".png", captured_image_resized)[
-                    1
-                ].tobytes()
-                window["-CAPTURED-"].update(data=captured_imgbytes)
+                gui_updates.update(
+                    window,
+                    "-CAPTURED-",
+                    data=reference_display.encode(diff_scale_factor),
+                )
 
         # Update stream width and height
         if event == "-WIDTH-":
@@ -451,34 +2289,80 @@ def video_capture():
         rect_h = int((bottom - top) * frame_height)
         rect = (rect_x, rect_y, rect_w, rect_h)
 
-        # Draw a rectangle in the middle of the frame
-        cv2.rectangle(
-            frame, (rect_x, rect_y), (rect_x + rect_w, rect_y + rect_h), (0, 255, 0), 2
-        )
+        if roi_overlay is not None and camera_frame.jpeg is not None:
+            # Pass the JPEG through untouched, the browser scales it and the
+            # rectangle is shown as a separate overlay element
+            gui_updates.defer(
+                window, update_roi_overlay, roi_overlay, top, right, bottom, left
+            )
+            gui_updates.defer(
+                window,
+                window["-IMAGE-"].Widget.style.__setitem__,
+                "width",
+                f"{int(frame_width * live_scale_factor)}px",
+            )
+            imgbytes = camera_frame.jpeg.tobytes()
+        else:
+            if roi_overlay is not None:
+                gui_updates.defer(
+                    window,
+                    update_roi_overlay,
+                    roi_overlay,
+                    top,
+                    right,
+                    bottom,
+                    left,
+                    False,
+                )
 
-        # Convert the frame to a format that can be displayed in PySimpleGUI
-        frame_resized = resize_image(frame, live_scale_factor)
-        imgbytes = cv2.imencode(".png", frame_resized)[1].tobytes()
-        window["-IMAGE-"].update(data=imgbytes)
+            # Draw the rectangle on a preview copy so the compared pixels stay clean
+            frame_resized = render_preview(
+                camera_frame, rect, (frame_width, frame_height), live_scale_factor
+            )
+
+            # Convert the frame to a format that can be displayed in PySimpleGUI
+            imgbytes = cv2.imencode(".png", frame_resized)[1].tobytes()
+        gui_updates.update(window, "-IMAGE-", data=imgbytes)
 
         if event == sg.WIN_CLOSED or event == "-QUIT-" or color_event == sg.WIN_CLOSED:
             print("Closing the window...")
             break
 
+        # Serve commands queued by the HTTP inspection service
+        while True:
+            try:
+                command, payload, future = inspection_state.commands.get_nowait()
+            except queue.Empty:
+                break
+            if command == "compare":
+                future.set_result(run_comparison())
+            elif command == "reference":
+                # Uploaded references are fitted to the current rectangle
+                if payload.shape[:2] != (rect_h, rect_w):
+                    payload = cv2.resize(
+                        payload, (rect_w, rect_h), interpolation=cv2.INTER_AREA
+                    )
+                set_reference(payload)
+                future.set_result({"reference": list(payload.shape)})
+
         if event == "-CAPTURE-":
             print("Capturing image...")
-            captured_image = capture_frame(frame, rect)
-            captured_image_resized = resize_image(captured_image, diff_scale_factor)
-            captured_imgbytes = cv2.imencode(".png", captured_image_resized)[
-                1
-            ].tobytes()
-            window["-CAPTURED-"].update(data=captured_imgbytes)
-            print("Image Captured!")
-
-            # Save the captured image to a file
-            filename = "captured_image.png"
-            cv2.imwrite(filename, captured_image)
-            print(f"Image saved as {filename}")
+            set_reference(capture_frame(camera_frame.image(), rect).copy())
+
+        if event in ("-HEATMAP-", "-HEATMAP-PEAK-"):
+            # The peak view shows the worst recent difference at each pixel
+            heatmap_image = heatmap.render(
+                captured_image, peak=event == "-HEATMAP-PEAK-"
+            )
+            if heatmap_image is None:
+                print("No comparisons yet for the heatmap.")
+            else:
+                heatmap_image = resize_image(heatmap_image, diff_scale_factor)
+                gui_updates.update(
+                    window,
+                    "-HEATMAP-IMAGE-",
+                    data=cv2.imencode(".png", heatmap_image)[1].tobytes(),
+                )
 
         if event == "-COMPARE-":
             print("Comparing images...")
@@ -490,13 +2374,35 @@ def video_capture():
                 print("Auto-compare mode enabled.")
             else:
                 print("Auto-compare mode disabled.")
+                gui_updates.update(window, "-RATE-", value="Auto Compare Rate : off")
 
-        if auto_compare:
-            run_comparison()
+        # Auto-compare only runs when the rate controller says it is due
+        if auto_compare and rate_controller.due():
+            started = time.monotonic()
+            run_comparison(rate_controller.scale_factor)
+            rate_controller.record(started, time.monotonic())
+
+            # Refresh the operating point at most once a second
+            if time.monotonic() - rate_shown_at >= 1.0:
+                rate_shown_at = time.monotonic()
+                gui_updates.update(window, "-RATE-", value=rate_controller.describe())
+                if pyramid_comparer is not None:
+                    gui_updates.update(
+                        window, "-PYRAMID-", value=pyramid_comparer.describe()
+                    )
+
+        # Show the latency distribution at most once a second
+        if time.monotonic() - latency_shown_at >= 1.0:
+            latency_shown_at = time.monotonic()
+            gui_updates.update(window, "-LATENCY-", value=latency_stats.describe())
+
+        # Apply everything this frame changed in one pass per window
+        gui_updates.flush()
 
     print("Closing the window...")
-    cap.release()
+    camera_switcher.close()
     print("Releasing the camera...")
+    close_services()
     cv2.destroyAllWindows()
     print("Destroy all cv2 window")
     window.close()
@@ -505,16 +2411,21 @@ def video_capture():
 
 
 # Run the video capture
-try:
-    video_capture()
-except Exception as err:
-    print(f"Error: {err}")
+if __name__ == "__main__":
+    try:
+        video_capture()
+    except Exception as err:
+        print(f"Error: {err}")
 
-    print("Closing the window...")
-    cap.release()
-    print("Releasing the camera...")
-    cv2.destroyAllWindows()
-    print("Destroy all cv2 window")
-    window.close()
-    color_window.close()
-    print("Window closed")
+        print("Closing the window...")
+        if cap is not None:
+            cap.release()
+        print("Releasing the camera...")
+        close_services()
+        cv2.destroyAllWindows()
+        print("Destroy all cv2 window")
+        if window is not None:
+            window.close()
+        if color_window is not None:
+            color_window.close()
+        print("Window closed")
@@ -0,0 +1,128 @@
+"""Benchmark for the patched remi gui module.
+
+Builds a widget tree about the size of the app.py window and times how long
+it takes to construct it, render it and refresh it after a single change.
+Run it after installing the patched module with patch_gui.sh:
+
+    python3 archive/bench_gui.py
+"""
+
+import timeit
+
+import remi.gui as gui
+from remi.server import App
+
+
+def build_layout():
+    # Roughly the app.py window: settings frames, action buttons and image columns
+    root = gui.VBox()
+    root.append(gui.Button("Quit App"))
+    columns = gui.HBox()
+    root.append(columns)
+
+    settings = gui.VBox()
+    columns.append(settings)
+    for frame_title in ("Stream Settings", "Camera and Rectangle Settings", "Similarity"):
+        frame = gui.VBox()
+        frame.append(gui.Label(frame_title))
+        for row_number in range(4):
+            row = gui.HBox()
+            row.append(gui.Label("Setting %s" % row_number))
+            row.append(gui.Slider(0.5, 0, 1, 0.01))
+            row.append(gui.Label("Value"))
+            row.append(gui.Slider(0.5, 0, 1, 0.01))
+            frame.append(row)
+        frame.append(gui.Button("Apply"))
+        settings.append(frame)
+
+    actions = gui.VBox()
+    columns.append(actions)
+    for button_title in ("Capture Reference", "Single Compare", "Auto Compare"):
+        actions.append(gui.Button(button_title))
+    actions.append(gui.Label("Important Info"))
+    actions.append(gui.Image(""))
+    actions.append(gui.Label("Live Frame"))
+
+    images = gui.HBox()
+    root.append(images)
+    for title in ("Captured Image", "Difference Image", "Current Frame"):
+        column = gui.VBox()
+        column.append(gui.Image(""))
+        column.append(gui.Label(title))
+        images.append(column)
+
+    status = gui.Label("Similarity : 0.00%")
+    root.append(status)
+    return root, status
+
+
+def build_long_list(children=2000):
+    container = gui.VBox()
+    for number in range(children):
+        container.append(gui.Label("Item %s" % number))
+    return container
+
+
+def check_image_url():
+    # Image data urls have to match the route the server dispatches attribute calls on
+    png = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+    for source in (png, "data:image/png;base64,iVBORw0KGgo="):
+        src = gui.Image(source).attributes["src"]
+        assert App.re_attr_call.match(src), "Image url %s matches no route" % src
+    print("Image data urls match the attribute call route")
+
+
+def main():
+    check_image_url()
+
+    repeat = 200
+    build = timeit.timeit(build_layout, number=repeat) / repeat
+    print("Build app-sized layout      : %8.3f ms" % (build * 1000))
+
+    root, status = build_layout()
+    full = timeit.timeit(lambda: root.repr({}), number=repeat) / repeat
+    print("Render app-sized layout     : %8.3f ms" % (full * 1000))
+
+    counter = [0]
+
+    def refresh():
+        counter[0] += 1
+        status.set_text("Similarity : %s" % counter[0])
+        root.repr({})
+
+    refresh_time = timeit.timeit(refresh, number=repeat) / repeat
+    print("Refresh after one change    : %8.3f ms" % (refresh_time * 1000))
+
+    long_list = build_long_list()
+    long_list.repr({})
+    counter = [0]
+    first = long_list.children[long_list._render_children_list[0]]
+
+    def refresh_list():
+        counter[0] += 1
+        first.set_text("Item %s" % counter[0])
+        long_list.repr({})
+
+    list_time = timeit.timeit(refresh_list, number=20) / 20
+    print("Refresh 2000-child container: %8.3f ms" % (list_time * 1000))
+
+    # Preview frames of the same size only differ near the end of the data uri
+    image = gui.Image("")
+    frames = [
+        "data:image/jpeg;base64," + "A" * 500000 + "%06d" % number
+        for number in range(2)
+    ]
+    counter = [0]
+
+    def set_frame():
+        counter[0] += 1
+        image.attributes["src"] = frames[counter[0] % 2]
+        image.style["width"] = "%spx" % (counter[0] % 7)
+        image.attributes["title"] = "Frame %s" % counter[0]
+
+    frame_time = timeit.timeit(set_frame, number=repeat) / repeat
+    print("Set 500 KB image src        : %8.3f ms" % (frame_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,8 @@ import functools
 import threading
 import collections
 import inspect
+import weakref
+import itertools
 try:
     import html
     escape = html.escape
@@ -54,6 +56,17 @@ log = logging.getLogger('remi.gui')
 
 pyLessThan3 = sys.version_info < (3,)
 
+# attribute values longer than this are compared by identity instead of content
+LARGE_VALUE_SIZE = 4096
+
+# versions of the images served by Image.get_image_data. Identifiers of short lived widgets are
+# reused and fixed ids survive a restart, the per process token and counter keep every url unique
+_image_token = base64.b32encode(os.urandom(5)).decode().lower()
+_image_versions = itertools.count(1)
+
+# counters of the runtimeInstances registry, reported by runtime_instances_stats
+_runtime_counters = collections.Counter()
+
 
 def to_pix(x):
     return str(x) + 'px'
@@ -72,6 +85,21 @@ def jsonize(d):
     return ';'.join(map(lambda k, v: k + ':' + v + '', d.keys(), d.values()))
 
 
+def runtime_instances_stats():
+    """Returns the counters of the runtimeInstances registry, useful to check that
+    long running sessions do not accumulate widgets.
+
+    Returns:
+        dict: 'registered' Tags currently reachable by the client, 'created' and 'collected' Tags
+            since startup, 'alive' Tags not collected yet and 'deregistered' Tags that were removed
+            from their parent.
+    """
+    created = _runtime_counters['created']
+    collected = _runtime_counters['collected']
+    return {'registered': len(runtimeInstances), 'created': created, 'collected': collected,
+            'alive': created - collected, 'deregistered': _runtime_counters['deregistered']}
+
+
 def load_resource(filename):
     """ Convenient function. Given a local path and filename (not in standard remi resource format),
         loads the content and returns a base64 encoded data.
@@ -107,22 +135,35 @@ def to_uri(uri_data):
     return ("url('%s')"%uri_data)
 
 
+# names of the event methods of each EventSource class, discovered once per class
+_event_method_names = {}
+
+
 class EventSource(object):
     def __init__(self, *args, **kwargs):
         self.setup_event_methods()
 
-    def setup_event_methods(self):
-        for (method_name, method) in inspect.getmembers(self, predicate=inspect.ismethod):
-            _event_info = None
-            if hasattr(method, "_event_info"):
-                _event_info = method._event_info
+    @classmethod
+    def event_method_names(cls):
+        names = _event_method_names.get(cls)
+        if names is None:
+            names = tuple(method_name for (method_name, method) in
+                          inspect.getmembers(cls, predicate=lambda m: inspect.isfunction(m) or inspect.ismethod(m))
+                          if hasattr(method, '__is_event'))
+            _event_method_names[cls] = names
+        return names
 
-            if hasattr(method, '__is_event'):
-                e = ClassEventConnector(self, method_name, method)
-                setattr(self, method_name, e)
+    def setup_event_methods(self):
+        for method_name in self.event_method_names():
+            method = getattr(self, method_name)
+            if not inspect.ismethod(method):
+                # already replaced by a ClassEventConnector
+                continue
+            e = ClassEventConnector(self, method_name, method)
+            setattr(self, method_name, e)
 
-            if _event_info:
-                getattr(self, method_name)._event_info = _event_info
+            if hasattr(method, "_event_info"):
+                e._event_info = method._event_info
 
 
 class ClassEventConnector(object):
@@ -239,7 +280,12 @@ class _EventDictionary(dict, EventSource):
 
     def __setitem__(self, key, value):
         if key in self:
-            if self[key] == value:
+            current = self[key]
+            if current is value:
+                return
+            # large payloads (image data uris) are tracked by identity, comparing
+            # their content would scan the whole payload on every update
+            if not (isinstance(value, str) and len(value) > LARGE_VALUE_SIZE) and current == value:
                 return
         ret = super(_EventDictionary, self).__setitem__(key, value)
         self.onchange()
@@ -301,6 +347,10 @@ class Tag(object):
             attributes={}
         self._parent = None
 
+        # True while this tag or one of its descendants has changes not yet rendered,
+        # unchanged subtrees are not walked again and their cached repr is reused
+        self._subtree_changed = True
+
         self.kwargs = kwargs
 
         self._render_children_list = []
@@ -309,6 +359,11 @@ class Tag(object):
         self.attributes = _EventDictionary()  # properties as class id style
         self.style = _EventDictionary()  # used by Widget, but instantiated here to make gui_updater simpler
 
+        # serialized attributes, rebuilt on the next repr after a change.
+        # Each attribute keeps its formatted fragment as long as its value is the same object
+        self._repr_attributes_cache = None
+        self._attribute_fragments = {}
+
         self.ignore_update = False
         self.children.onchange.connect(self._need_update)
         self.attributes.onchange.connect(self._need_update)
@@ -318,12 +373,16 @@ class Tag(object):
         self.identifier = str(id(self))
 
         #attribute['id'] can be overwritten to get a static Tag identifier
+        if 'id' in attributes:
+            del runtimeInstances[self.identifier]
         self.attributes.update(attributes)
 
         # the runtime instances are processed every time a requests arrives, searching for the called method
         # if a class instance is not present in the runtimeInstances, it will
         # we not callable
         runtimeInstances[self.identifier] = self
+        _runtime_counters['created'] += 1
+        weakref.finalize(self, _runtime_counters.update, ('collected',)).atexit = False
 
         self._classes = []
         self.add_class(self.__class__.__name__ if _class == None else _class)
@@ -343,22 +402,26 @@ class Tag(object):
         Args:
             new_identifier (str): a unique id for the tag
         """
+        old_identifier = self.attributes.get('id')
+        if old_identifier is not None and runtimeInstances.get(old_identifier) is self:
+            del runtimeInstances[old_identifier]
         self.attributes['id'] = new_identifier
         runtimeInstances[new_identifier] = self
 
     def innerHTML(self, local_changed_widgets):
-        ret = ''
+        # children fragments are collected and joined once, concatenating in the loop is quadratic
+        fragments = []
         for k in self._render_children_list:
             s = self.children[k]
             if isinstance(s, Tag):
-                ret = ret + s.repr(local_changed_widgets)
+                fragments.append(s.repr(local_changed_widgets))
             elif isinstance(s, type('')):
-                ret = ret + s
+                fragments.append(s)
             elif isinstance(s, type(u'')):
-                ret = ret + s.encode('utf-8')
+                fragments.append(s.encode('utf-8'))
             else:
-                ret = ret + repr(s)
-        return ret
+                fragments.append(repr(s))
+        return ''.join(fragments)
 
     def repr(self, changed_widgets=None):
         """It is used to automatically represent the object to HTML format
@@ -370,6 +433,9 @@ class Tag(object):
         """
         if changed_widgets is None:
             changed_widgets = {}
+        if not self._subtree_changed and self._backup_repr:
+            # nothing changed below this tag since the last repr
+            return self._backup_repr
         local_changed_widgets = {}
         _innerHTML = self.innerHTML(local_changed_widgets)
 
@@ -385,17 +451,37 @@ class Tag(object):
             self._set_updated()
         else:
             changed_widgets.update(local_changed_widgets)
+        self._subtree_changed = False
         return self._backup_repr
 
-    def _need_update(self, emitter=None):
-        #if there is an emitter, it means self is the actual changed widget
-        if emitter:
+    @property
+    def _repr_attributes(self):
+        if self._repr_attributes_cache is None:
             tmp = dict(self.attributes)
             if len(self.style):
                 tmp['style'] = jsonize(self.style)
-            self._repr_attributes = ' '.join('%s="%s"' % (k, v) if v is not None else k for k, v in
-                                                tmp.items())
-            
+            fragments = {}
+            for k, v in tmp.items():
+                cached = self._attribute_fragments.get(k)
+                if cached is None or cached[0] is not v:
+                    cached = (v, '%s="%s"' % (k, v) if v is not None else k)
+                fragments[k] = cached
+            self._attribute_fragments = fragments
+            self._repr_attributes_cache = ' '.join(fragment for v, fragment in fragments.values())
+        return self._repr_attributes_cache
+
+    def _need_update(self, emitter=None):
+        #if there is an emitter, it means self is the actual changed widget
+        if emitter:
+            self._repr_attributes_cache = None
+
+        # mark the path to the root, even with refresh disabled the change has to be rendered
+        # the next time. An already marked ancestor means the rest of the path is marked too
+        node = self
+        while isinstance(node, Tag) and not node._subtree_changed:
+            node._subtree_changed = True
+            node = node.get_parent()
+
         if not self.ignore_update:
             if self.get_parent():
                 self.get_parent()._need_update()
@@ -407,6 +493,7 @@ class Tag(object):
         self.children.align_version()
         self.attributes.align_version()
         self.style.align_version()
+        self._subtree_changed = False
 
     def disable_refresh(self):
         self.ignore_update = True
@@ -447,12 +534,17 @@ class Tag(object):
                 i = i + 1
             return
 
+        if key in self.children:
+            self._render_children_list.remove(key)
+            if self.children[key] is not value:
+                self._release_child(self.children[key])
+
         if hasattr(value, 'attributes'):
             value.attributes['data-parent-widget'] = self.identifier
             value._parent = self
-
-        if key in self.children:
-            self._render_children_list.remove(key)
+            # a child that was removed before gets registered again with its subtree
+            if runtimeInstances.get(value.identifier) is not value:
+                value._register_subtree(True)
         self._render_children_list.append(key)
 
         self.children[key] = value
@@ -488,11 +580,31 @@ class Tag(object):
                     if self.children[k].identifier == child.identifier:
                         if k in self._render_children_list:
                             self._render_children_list.remove(k)
-                        self.children.pop(k)
+                        self._release_child(self.children.pop(k))
                         # when the child is removed we stop the iteration
                         # this implies that a child replication should not be allowed
                         break
 
+    def _release_child(self, child):
+        """Unlinks a removed child from this Tag and drops its subtree from runtimeInstances,
+        a widget that is not shown can't receive events and is kept alive only by the user.
+        """
+        if isinstance(child, Tag):
+            if child._parent is self:
+                child._parent = None
+            child._register_subtree(False)
+
+    def _register_subtree(self, registered):
+        pending = [self]
+        while pending:
+            tag = pending.pop()
+            if registered:
+                runtimeInstances[tag.identifier] = tag
+            elif runtimeInstances.get(tag.identifier) is tag:
+                del runtimeInstances[tag.identifier]
+                _runtime_counters['deregistered'] += 1
+            pending.extend(c for c in tag.children.values() if isinstance(c, Tag))
+
 
 class Widget(Tag, EventSource):
     """ Base class for graphical gui widgets.
@@ -2822,15 +2934,59 @@ class Image(Widget):
         """
         super(Image, self).__init__(*args, **kwargs)
         self.type = 'img'
-        self.attributes['src'] = image
+        self._image_data = None
+        self._image_mimetype = None
+        self._image_version = None
+        self.set_image(image)
 
     def set_image(self, image):
         """
         Args:
-            image (str): an url to an image or a base64 data string
+            image (str, bytes): an url to an image, a base64 data string or the raw image bytes.
+                Data strings and raw bytes are served from get_image_data, so that only
+                the url goes through the page update.
         """
+        if not pyLessThan3 and isinstance(image, bytes):
+            self.set_image_data(image)
+            return
+        if isinstance(image, str) and image.startswith('data:') and ';base64,' in image:
+            header, data = image.split(',', 1)
+            self.set_image_data(base64.b64decode(data), header[5:].split(';')[0])
+            return
         self.attributes['src'] = image
 
+    def set_image_data(self, data, mimetype=None):
+        """ Serves the image from a versioned url, /<identifier>/get_image_data?version=<n>.
+            The browser fetches the binary data, instead of receiving it base64 encoded
+            in the src attribute with every update.
+
+            Args:
+                data (bytes): the encoded image (ie. png or jpeg)
+                mimetype (str): the image mimetype, guessed from the data if None
+        """
+        if mimetype is None:
+            if data[:4] == b'\x89PNG':
+                mimetype = 'image/png'
+            elif data[:2] == b'\xff\xd8':
+                mimetype = 'image/jpeg'
+            elif data[:4] == b'GIF8':
+                mimetype = 'image/gif'
+        self._image_data = data
+        self._image_mimetype = mimetype
+        # server.App.re_attr_call only accepts word characters and dots in query values
+        self._image_version = '%s_%d' % (_image_token, next(_image_versions))
+        self.attributes['src'] = "/%s/get_image_data?version=%s" % (self.identifier, self._image_version)
+
+    def get_image_data(self, version=None):
+        """ Called by the browser to load the image set by set_image_data.
+            Every new image gets a new url, so each version can be cached.
+        """
+        # a request for an older version gets the current image, which must not be cached under its url
+        cache_control = 'public, max-age=86400' if version == self._image_version else 'no-cache'
+        headers = {'Content-type': self._image_mimetype or 'application/octet-stream',
+                   'Cache-Control': cache_control}
+        return [self._image_data, headers]
+
 
 class Table(Container):
     """